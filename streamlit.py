@@ -1,7 +1,12 @@
 import streamlit as st
-import requests
-import json
-from typing import Dict, List
+import httpx
+import orjson
+from collections import OrderedDict, deque
+from contextlib import closing
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import hashlib
+import random
+import threading
 import time
 
 # Page configuration
@@ -87,10 +92,100 @@ GROQ_MODELS = [
     "gemma2-9b-it"
 ]
 
+# Selectbox options and lookup tables, built once instead of on every rerun
+PERSONALITY_OPTIONS = tuple(PERSONALITIES.keys())
+PERSONALITY_INDEX = {name: i for i, name in enumerate(PERSONALITY_OPTIONS)}
+GROQ_MODEL_INDEX = {model: i for i, model in enumerate(GROQ_MODELS)}
+
+# System prompts are static per personality, so their API messages are built once
+SYSTEM_MESSAGES = {
+    name: ({"role": "system", "content": personality["system_prompt"]},)
+    for name, personality in PERSONALITIES.items()
+}
+
+# Chat history kept in session state (20 exchanges) and the token budget of the part sent to the API
+MAX_HISTORY_MESSAGES = 40
+MAX_CONTEXT_TOKENS = 3000
+MESSAGE_TOKEN_OVERHEAD = 4  # role and separator tokens added per message
+CHARS_PER_TOKEN = 4  # rough average for English text across the Groq models' tokenizers
+
+# Completed responses are reused for identical (API key, model, prompt window) requests
+RESPONSE_CACHE_TTL = 3600  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = 256
+
+# Transient Groq errors (rate limits, overload) are retried with exponential backoff and jitter
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5  # seconds, doubled on each attempt
+RETRY_MAX_DELAY = 10  # seconds; a longer Retry-After is reported to the user instead
+CONNECT_RETRIES = 2  # handled by the transport, separately from status retries
+
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    """Create the shared HTTP/2 client for Groq, cached across reruns and sessions"""
+    return httpx.Client(
+        transport=httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            retries=CONNECT_RETRIES
+        ),
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        headers={"Content-Type": "application/json"}
+    )
+
+@st.cache_resource
+def get_response_cache() -> Tuple[threading.Lock, OrderedDict]:
+    """Create the shared response cache and its lock, cached across reruns and sessions"""
+    return threading.Lock(), OrderedDict()
+
+def get_cached_response(key: Tuple) -> Optional[str]:
+    """Return a cached response that has not expired, if any"""
+    lock, cache = get_response_cache()
+    with lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        stored_at, response = entry
+        if time.monotonic() - stored_at > RESPONSE_CACHE_TTL:
+            del cache[key]
+            return None
+        return response
+
+def cache_response(key: Tuple, response: str):
+    """Store a completed response, evicting the oldest entries beyond the size limit"""
+    lock, cache = get_response_cache()
+    with lock:
+        cache[key] = (time.monotonic(), response)
+        cache.move_to_end(key)
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+def estimate_tokens(content: str) -> int:
+    """Estimate the prompt tokens a message adds, without a model-specific tokenizer"""
+    return len(content) // CHARS_PER_TOKEN + MESSAGE_TOKEN_OVERHEAD
+
+def trim_history(messages: Sequence[Dict], token_counts: Sequence[int], budget: int = MAX_CONTEXT_TOKENS) -> List[Dict]:
+    """Return the most recent messages that fit within the token budget"""
+    total = 0
+    recent = []
+    for message, tokens in zip(reversed(messages), reversed(token_counts)):
+        # Always keep the newest message, even if it alone exceeds the budget
+        if recent and total + tokens > budget:
+            break
+        recent.append(message)
+        total += tokens
+    recent.reverse()
+    return recent
+
 def init_session_state():
     """Initialize session state variables"""
     if "messages" not in st.session_state:
-        st.session_state.messages = []
+        st.session_state.messages = deque(maxlen=MAX_HISTORY_MESSAGES)
+    if "token_counts" not in st.session_state:
+        # Estimated tokens per message, parallel to messages so the API payload stays unchanged
+        st.session_state.token_counts = deque(maxlen=MAX_HISTORY_MESSAGES)
+    if "role_counts" not in st.session_state:
+        st.session_state.role_counts = {"user": 0, "assistant": 0}
     if "groq_api_key" not in st.session_state:
         st.session_state.groq_api_key = ""
     if "selected_personality" not in st.session_state:
@@ -98,47 +193,107 @@ def init_session_state():
     if "selected_model" not in st.session_state:
         st.session_state.selected_model = "llama-3.1-70b-versatile"
 
-def call_groq_api(messages: List[Dict], api_key: str, model: str) -> str:
-    """Make API call to Groq"""
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
+def send_with_retry(client: httpx.Client, request: httpx.Request) -> httpx.Response:
+    """Send a streaming request, retrying transient error statuses with backoff"""
+    for attempt in range(MAX_RETRIES + 1):
+        response = client.send(request, stream=True)
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return response
+        
+        delay = RETRY_BACKOFF * 2 ** attempt + random.uniform(0, RETRY_BACKOFF)
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            if int(retry_after) > RETRY_MAX_DELAY:
+                return response
+            delay = max(delay, int(retry_after))
+        
+        response.close()
+        time.sleep(delay)
+
+def stream_groq(messages: List[Dict], api_key: str, model: str) -> Iterator[str]:
+    """Stream a chat completion from Groq, yielding content tokens as they arrive"""
+    # Keyed by a hash of the API key so responses are only reused by the key that paid for them
+    cache_key = (
+        hashlib.sha256(api_key.encode()).hexdigest(),
+        model,
+        tuple((m["role"], m["content"]) for m in messages)
+    )
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        yield cached
+        return
     
     data = {
         "model": model,
         "messages": messages,
         "temperature": 0.7,
         "max_tokens": 1024,
-        "stream": False
+        "stream": True
     }
     
+    client = get_http_client()
+    request = client.build_request(
+        "POST",
+        "https://api.groq.com/openai/v1/chat/completions",
+        headers={"Authorization": f"Bearer {api_key}"},
+        content=orjson.dumps(data)
+    )
+    
     try:
-        response = requests.post(
-            "https://api.groq.com/openai/v1/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=30
-        )
+        # Retries happen before the first token, so show progress until the stream opens
+        with st.spinner("Thinking..."):
+            response = send_with_retry(client, request)
         
-        if response.status_code == 200:
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        else:
-            st.error(f"API Error: {response.status_code} - {response.text}")
-            return "Sorry, I encountered an error processing your request."
+        with closing(response):
+            if response.status_code != 200:
+                response.read()
+                st.error(f"API Error: {response.status_code} - {response.text}")
+                yield "Sorry, I encountered an error processing your request."
+                return
+            
+            # Server-sent events: each payload line is "data: {...}", terminated by "data: [DONE]"
+            chunks = []
+            for line in response.iter_lines():
+                if not line.startswith("data: "):
+                    continue
+                payload = line[6:]
+                if payload == "[DONE]":
+                    # Only complete responses are cached, never errors or partial output
+                    cache_response(cache_key, "".join(chunks))
+                    break
+                delta = orjson.loads(payload)["choices"][0]["delta"].get("content")
+                if delta:
+                    chunks.append(delta)
+                    yield delta
             
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         st.error("Request timed out. Please try again.")
-        return "Request timed out. Please try again."
+        yield "Request timed out. Please try again."
     except Exception as e:
         st.error(f"Error: {str(e)}")
-        return "Sorry, I encountered an error processing your request."
+        yield "Sorry, I encountered an error processing your request."
+
+def append_message(role: str, content: str):
+    """Add a message to the chat history and update the per-role and token counts"""
+    messages = st.session_state.messages
+    if len(messages) == messages.maxlen:
+        # The deque is about to drop its oldest message, so stop counting it
+        st.session_state.role_counts[messages[0]["role"]] -= 1
+    messages.append({"role": role, "content": content})
+    st.session_state.token_counts.append(estimate_tokens(content))
+    st.session_state.role_counts[role] += 1
+
+def render_chat():
+    """Render the chat history"""
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
 
 def clear_chat():
     """Clear the chat history"""
-    st.session_state.messages = []
-    st.rerun()
+    st.session_state.messages.clear()
+    st.session_state.token_counts.clear()
+    st.session_state.role_counts = {"user": 0, "assistant": 0}
 
 def main():
     init_session_state()
@@ -151,50 +306,57 @@ def main():
     with st.sidebar:
         st.header("⚙️ Configuration")
         
-        # API Key input
-        api_key = st.text_input(
-            "🔑 Groq API Key",
-            value=st.session_state.groq_api_key,
-            type="password",
-            help="Enter your Groq API key. Get one at https://console.groq.com/"
-        )
-        st.session_state.groq_api_key = api_key
+        # Settings are applied together on submit, so editing them doesn't rerun the app
+        with st.form("config_form", clear_on_submit=False):
+            # API Key input
+            api_key = st.text_input(
+                "🔑 Groq API Key",
+                value=st.session_state.groq_api_key,
+                type="password",
+                help="Enter your Groq API key. Get one at https://console.groq.com/"
+            )
+            
+            st.divider()
+            
+            # Model selection
+            st.subheader("🧠 AI Model")
+            selected_model = st.selectbox(
+                "Choose AI Model:",
+                GROQ_MODELS,
+                index=GROQ_MODEL_INDEX[st.session_state.selected_model],
+                help="Different models have varying capabilities and response speeds"
+            )
+            
+            st.divider()
+            
+            # Personality selection
+            st.subheader("🎭 Chatbot Personality")
+            
+            # Display personality options with icons and descriptions
+            selected_personality = st.selectbox(
+                "Choose Personality:",
+                PERSONALITY_OPTIONS,
+                index=PERSONALITY_INDEX[st.session_state.selected_personality]
+            )
+            
+            if st.form_submit_button("✅ Apply", use_container_width=True):
+                st.session_state.groq_api_key = api_key
+                st.session_state.selected_model = selected_model
+                if selected_personality != st.session_state.selected_personality:
+                    st.session_state.selected_personality = selected_personality
+                    # Clear messages when personality changes
+                    clear_chat()
+        
+        # Use the applied settings, not unsubmitted edits in the form
+        api_key = st.session_state.groq_api_key
+        selected_model = st.session_state.selected_model
+        selected_personality = st.session_state.selected_personality
         
         if not api_key:
             st.warning("⚠️ Please enter your Groq API key to start chatting!")
             st.markdown("Get your free API key at [Groq Console](https://console.groq.com/)")
         
-        st.divider()
-        
-        # Model selection
-        st.subheader("🧠 AI Model")
-        selected_model = st.selectbox(
-            "Choose AI Model:",
-            GROQ_MODELS,
-            index=GROQ_MODELS.index(st.session_state.selected_model),
-            help="Different models have varying capabilities and response speeds"
-        )
-        st.session_state.selected_model = selected_model
-        
-        st.divider()
-        
-        # Personality selection
-        st.subheader("🎭 Chatbot Personality")
-        
-        # Display personality options with icons and descriptions
-        personality_options = list(PERSONALITIES.keys())
-        selected_personality = st.selectbox(
-            "Choose Personality:",
-            personality_options,
-            index=personality_options.index(st.session_state.selected_personality)
-        )
-        
         # Show personality info
-        if selected_personality != st.session_state.selected_personality:
-            st.session_state.selected_personality = selected_personality
-            # Clear messages when personality changes
-            st.session_state.messages = []
-        
         personality_info = PERSONALITIES[selected_personality]
         st.markdown(f"**{personality_info['icon']} {selected_personality}**")
         st.markdown(f"*{personality_info['description']}*")
@@ -202,16 +364,13 @@ def main():
         st.divider()
         
         # Clear chat button
-        if st.button("🗑️ Clear Chat", use_container_width=True):
-            clear_chat()
+        st.button("🗑️ Clear Chat", on_click=clear_chat, use_container_width=True)
         
         # Chat statistics
         if st.session_state.messages:
             st.subheader("📊 Chat Stats")
-            user_messages = len([msg for msg in st.session_state.messages if msg["role"] == "user"])
-            assistant_messages = len([msg for msg in st.session_state.messages if msg["role"] == "assistant"])
-            st.metric("User Messages", user_messages)
-            st.metric("AI Responses", assistant_messages)
+            st.metric("User Messages", st.session_state.role_counts["user"])
+            st.metric("AI Responses", st.session_state.role_counts["assistant"])
 
     # Main chat interface
     if not api_key:
@@ -240,34 +399,28 @@ def main():
     
     with chat_container:
         # Display chat messages
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+        render_chat()
     
     # Chat input
     if prompt := st.chat_input(f"Ask {selected_personality} a question..."):
         # Add user message
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        append_message("user", prompt)
         
         with st.chat_message("user"):
             st.markdown(prompt)
         
         # Prepare messages for API call
-        personality_prompt = PERSONALITIES[selected_personality]["system_prompt"]
-        api_messages = [{"role": "system", "content": personality_prompt}]
+        api_messages = list(SYSTEM_MESSAGES[selected_personality])
         
-        # Add conversation history (limit to last 10 exchanges to manage token usage)
-        recent_messages = st.session_state.messages[-20:]  # Last 20 messages (10 exchanges)
-        api_messages.extend(recent_messages)
+        # Add conversation history (limit to the most recent messages within the token budget)
+        api_messages.extend(trim_history(st.session_state.messages, st.session_state.token_counts))
         
         # Generate response
         with st.chat_message("assistant"):
-            with st.spinner(f"{selected_personality} is thinking..."):
-                response = call_groq_api(api_messages, api_key, selected_model)
-                st.markdown(response)
+            response = st.write_stream(stream_groq(api_messages, api_key, selected_model))
         
         # Add assistant response to session state
-        st.session_state.messages.append({"role": "assistant", "content": response})
+        append_message("assistant", response)
 
     # Footer
     st.markdown("---")